@@ -1,43 +1,212 @@
-from json import JSONDecodeError
-from simpleeval import simple_eval, InvalidExpression
-from ollama import chat
-import json
+from array import array
+from ollama import AsyncClient, ResponseError
+import ast
+import asyncio
+import hashlib
+import logging
+import logging.handlers
 import math
+import os
+import sys
+import threading
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+try:
+    from numba import boolean, int64, njit
+except ImportError:
+    njit = None
+
+# Tool diagnostics are buffered and flushed once per turn instead of
+# writing to stdout line by line. Tool errors are not logged; they are
+# returned as the answer (see ToolError). Set
+# MATHAGENT_LOG_LEVEL=DEBUG to see which tool ran with which inputs.
+logger = logging.getLogger('mathagent')
+logger.setLevel(os.getenv('MATHAGENT_LOG_LEVEL', 'WARNING').upper())
+_log_handler = logging.handlers.MemoryHandler(
+    capacity=64, target=logging.StreamHandler(sys.stdout))
+logger.addHandler(_log_handler)
+
+# Tool results are already exact, so by default they are reported with a
+# fixed template; MATHAGENT_NATURAL=1 restores the extra LLM call that
+# rewords them in natural language.
+NATURAL_SUMMARY = os.getenv('MATHAGENT_NATURAL') == '1'
+
+# Routing is a small classification/extraction task, so it runs on a
+# small quantized model; the full model is only used to reword results.
+ROUTER_MODEL = os.getenv('ROUTER_MODEL', 'llama3.2:1b-instruct-q4_K_M')
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'llama3.1')
+
+# Number of piped questions dispatched together in script mode; match it to
+# the server's OLLAMA_NUM_PARALLEL.
+BATCH_SIZE = max(1, int(os.getenv('MATHAGENT_BATCH_SIZE', '4')))
+
+# Options shared by every router call. num_keep is filled in by warm_up()
+# with the token count of the system prompt so Ollama never evicts it.
+ROUTER_OPTIONS = {}
+
+# Keep the models resident for the whole session so neither the weights
+# nor the cached prefix have to be reloaded between turns.
+KEEP_ALIVE = os.getenv('MATHAGENT_KEEP_ALIVE', '24h')
 
-messages = []
 
-ALGORITHM_TOOLS = {
-    "gcd": (math.gcd, "inputs: [a, b]"),
-    "lcm": (math.lcm, "inputs: [a, b]"),
-    "factorial": (math.factorial, "inputs: [n]"),
+def _is_prime_py(n):
+    # Trial division over the 6k ± 1 wheel.
+    if n < 4:
+        return n > 1
+    if n % 2 == 0 or n % 3 == 0:
+        return False
+    i = 5
+    while i * i <= n:
+        if n % i == 0 or n % (i + 2) == 0:
+            return False
+        i += 6
+    return True
+
+
+# The trial-division loop is the only tool hot enough to be worth JIT-ing.
+# An explicit signature compiles eagerly at import and cache=True keeps the
+# machine code on disk. factorial and fibonacci need arbitrary-precision
+# ints, which numba does not support, so they stay in Python.
+_is_prime_jit = njit(boolean(int64), cache=True)(_is_prime_py) if njit else None
+
+# Keeps i * i in the loop clear of int64 overflow.
+_JIT_PRIME_LIMIT = 2 ** 62
+
+# Largest n the is_prime tool accepts. The pure-Python loop needs about
+# half a second near 10**14 and blocks the event loop while it runs, so
+# only the JIT-compiled loop is trusted up to the int64-safe limit.
+_MAX_PRIME_N = _JIT_PRIME_LIMIT if _is_prime_jit is not None else 10 ** 14
+
+
+@lru_cache(maxsize=1024)
+def _is_prime(n):
+    if _is_prime_jit is not None and type(n) is int and 0 <= n < _JIT_PRIME_LIMIT:
+        return _is_prime_jit(n)
+    return _is_prime_py(n)
+
+
+def _fib_pair(n):
+    # Fast doubling: returns (F(n), F(n + 1)) using
+    # F(2k) = F(k)(2F(k+1) - F(k)) and F(2k+1) = F(k)² + F(k+1)².
+    if n == 0:
+        return 0, 1
+    a, b = _fib_pair(n >> 1)
+    c = a * (2 * b - a)
+    d = a * a + b * b
+    if n & 1:
+        return d, c + d
+    return c, d
+
+
+@lru_cache(maxsize=1024)
+def _fib(n):
+    if n < 0:
+        raise ValueError('fibonacci is only defined for non-negative n')
+    return _fib_pair(n)[0]
+
+
+_factorial = lru_cache(maxsize=1024)(math.factorial)
+
+# sin() sampled every 0.1° over one full turn. Inputs that land exactly on
+# a sample (every whole degree does) are read from the table; anything in
+# between falls back to math.sin, so results are never less precise than
+# libm. The index wraps because a tiny negative d makes d % 360 round to
+# exactly 360.0.
+_SIN_TABLE = array('d', [math.sin(math.radians(d / 10)) for d in range(3600)])
+
+
+def _sin_deg(d):
+    pos = (d % 360) * 10
+    i = int(pos)
+    if i == pos:
+        return _SIN_TABLE[i % 3600]
+    return math.sin(math.radians(d))
+
+
+def _cos_deg(d):
+    return _sin_deg(d + 90)
+
+
+def _tan_deg(d):
+    c = _cos_deg(d)
+    if abs(c) < 1e-12:
+        raise ValueError(f'tan is undefined at {d} degrees')
+    return _sin_deg(d) / c
+
+
+def _ints(xs):
+    # bool is an int subclass, so compare types exactly.
+    return all(type(x) is int for x in xs)
+
+
+def _nums(xs):
+    return all(type(x) in (int, float) for x in xs)
+
+
+def _positive(xs):
+    return _nums(xs) and all(x > 0 for x in xs)
 
-    "is_prime": (lambda n: n > 1 and all(
-        n % i != 0 for i in range(2, int(n ** 0.5) + 1)),
-                 "inputs: [n]"),
 
-    "nth_root": (lambda n, r: n ** (1 / r), "inputs: [n, root]"),
-    "log": (math.log, "inputs: [n, base]"),
-    "log2": (math.log2, "inputs: [n]"),
-    "log10": (math.log10, "inputs: [n]"),
+@dataclass(slots=True, frozen=True)
+class ToolSpec:
+    func: Callable
+    params: tuple
+    # Runs after the arity check, so it can index inputs directly.
+    validate: Callable
+    arity: int = field(init=False)
 
-    "fibonacci": (lambda n: int(
-        (((1 + 5 ** 0.5) / 2) ** n -
-         ((1 - 5 ** 0.5) / 2) ** n) / 5 ** 0.5), "inputs: [n]"),
+    def __post_init__(self):
+        object.__setattr__(self, 'arity', len(self.params))
 
-    "circle_area": (lambda r: math.pi * r ** 2, "inputs: [radius]"),
-    "hypotenuse": (math.hypot, "inputs: [a, b]"),
 
-    "sin": (lambda d: math.sin(math.radians(d)), "inputs: [degrees]"),
-    "cos": (lambda d: math.cos(math.radians(d)), "inputs: [degrees]"),
-    "tan": (lambda d: math.tan(math.radians(d)), "inputs: [degrees]"),
+# Largest inputs worth accepting: their results stay under CPython's
+# default 4300-digit int-to-str limit (which 1559! and F(20578) exceed),
+# so every call that passes validation can be reported.
+_MAX_FACTORIAL_N = 1500
+_MAX_FIBONACCI_N = 20000
+
+ALGORITHM_TOOLS = {
+    "gcd": ToolSpec(math.gcd, ("a", "b"), _ints),
+    "lcm": ToolSpec(math.lcm, ("a", "b"), _ints),
+    "factorial": ToolSpec(_factorial, ("n",), lambda xs: _ints(xs) and 0 <= xs[0] <= _MAX_FACTORIAL_N),
+    "is_prime": ToolSpec(_is_prime, ("n",), lambda xs: _ints(xs) and xs[0] <= _MAX_PRIME_N),
+
+    "nth_root": ToolSpec(lambda n, r: n ** (1 / r), ("n", "root"), lambda xs: _nums(xs) and xs[1] != 0),
+    "log": ToolSpec(math.log, ("n", "base"), lambda xs: _positive(xs) and xs[1] != 1),
+    "log2": ToolSpec(math.log2, ("n",), _positive),
+    "log10": ToolSpec(math.log10, ("n",), _positive),
+
+    "fibonacci": ToolSpec(_fib, ("n",), lambda xs: _ints(xs) and 0 <= xs[0] <= _MAX_FIBONACCI_N),
+
+    "circle_area": ToolSpec(lambda r: math.pi * r ** 2, ("radius",), _nums),
+    "hypotenuse": ToolSpec(math.hypot, ("a", "b"), _nums),
+
+    "sin": ToolSpec(_sin_deg, ("degrees",), _nums),
+    "cos": ToolSpec(_cos_deg, ("degrees",), _nums),
+    "tan": ToolSpec(_tan_deg, ("degrees",), _nums),
 }
 
 tool_descriptions = "\n".join(
-    f'  - "{name}": {desc}'
-    for name, (_, desc) in ALGORITHM_TOOLS.items()
+    f'  - "{name}": inputs: [{", ".join(spec.params)}]'
+    for name, spec in ALGORITHM_TOOLS.items()
 )
 
-SYSTEM_PROMPT = """You are a calculator tool-calling agent.
+# The pre-compaction rule-based prompt: the original 16 rules minus the
+# four output-format rules the JSON schema now enforces, renumbered 1-12.
+# Kept for regression testing with MATHAGENT_PROMPT=v1.
+SYSTEM_PROMPT_V1 = """You are a calculator tool-calling agent.
 
 Rule 1: Always respond with a raw JSON object. The keys in the object depend on which tool is being called:
 
@@ -48,23 +217,19 @@ Rule 1: Always respond with a raw JSON object. The keys in the object depend on
   
 Rule 2: The value of "tool" must be "calculator", "converter", "algorithm", or "none".
 Rule 3: The value of "expression" must be the math expression extracted from the user's message.
-Rule 4: Do NOT wrap the output in markdown code fences.
-Rule 5: Do NOT use ```json or ``` anywhere in your response.
-Rule 6: Do NOT add any explanation, commentary, or extra text.
-Rule 7: Your entire response must start with { and end with }.
-Rule 8: If the user's message does not contain a math expression, you MUST respond with exactly this, no variation: {"tool": "none", "expression": ""}
-Rule 9: If the user's message contains a unit conversion, respond with a JSON object 
+Rule 4: If the user's message does not contain a math expression, you MUST respond with exactly this, no variation: {"tool": "none", "expression": ""}
+Rule 5: If the user's message contains a unit conversion, respond with a JSON object 
 with keys: "tool" (value: "converter"), "value" (a number), "from_unit" (a string in lowercase and always in abbreviation), 
 and "to_unit" (a string in lowercase and always in abbreviation).
-Rule 10: "value" must always be the numeric quantity the user wants to convert, 
+Rule 6: "value" must always be the numeric quantity the user wants to convert, 
 extracted exactly as stated. Never substitute 0 or any default.
-Rule 11: Convert natural language math to Python expressions using only operators, 
+Rule 7: Convert natural language math to Python expressions using only operators, 
 no functions. Examples:
   - "square root of 25"  → "25 ** 0.5"
   - "2 to the power of 8" → "2 ** 8"
   - "cube root of 27"    → "27 ** (1/3)"
   
-Rule 12: NEVER use math functions in expressions. This includes sqrt(), pow(), abs(), 
+Rule 8: NEVER use math functions in expressions. This includes sqrt(), pow(), abs(), 
 round(), or any other function call. You MUST convert everything to operators only.
 Forbidden → Allowed:
   - sqrt(25)     → 25 ** 0.5
@@ -73,17 +238,17 @@ Forbidden → Allowed:
   - sqrt(x**2)   → (x**2) ** 0.5
 If you cannot express the operation using only +, -, *, /, **, (, ), you must not attempt it.
 
-Rule 13: Available algorithm operations — use these exact operation names:
+Rule 9: Available algorithm operations — use these exact operation names:
 """ + tool_descriptions + """
 
-Rule 14: You are ONLY allowed to use these resources:
+Rule 10: You are ONLY allowed to use these resources:
 
   For "calculator" tool — these operators and nothing else:
     +  -  *  /  **  %  ( )
     No list comprehensions, no range(), no loops, no "if", no "for", 
     no Python syntax beyond simple arithmetic expressions.
 
-  For "algorithm" tool — only the exact operation names listed in Rule 13.
+  For "algorithm" tool — only the exact operation names listed in Rule 9.
     If the user's question cannot be answered using one of those operations
     or a simple arithmetic expression, respond with {"tool": "none", "expression": ""}
 
@@ -93,7 +258,7 @@ Rule 14: You are ONLY allowed to use these resources:
     any(... for ...)         ❌
   — stop and route to "none" instead.
   
-Rule 15: If a question can be answered by an algorithm operation AND a calculator 
+Rule 11: If a question can be answered by an algorithm operation AND a calculator 
 expression, always prefer the "algorithm" tool. It is more precise.
 Examples:
   - "square root of 25" → calculator (25 ** 0.5) because "nth_root" exists but 
@@ -103,7 +268,7 @@ Examples:
   - "factorial of 5"    → algorithm (factorial) NOT "5*4*3*2*1" as a calculator 
     expression, because the algorithm tool handles it exactly
 
-Rule 16: Never infer, assume, or hallucinate inputs that the user did not explicitly 
+Rule 12: Never infer, assume, or hallucinate inputs that the user did not explicitly 
 state. If a required input is missing or ambiguous, respond with {"tool": "none", 
 "expression": ""} instead of guessing.
 Examples of what NOT to do:
@@ -137,36 +302,238 @@ Required output: {"tool": "converter", "value": 32, "from_unit": "fahrenheit", "
 
 """
 
+operation_signatures = ", ".join(
+    f'{name}({", ".join(spec.params)})'
+    for name, spec in ALGORITHM_TOOLS.items()
+)
+
+# Compact prompt: the JSON-schema format already enforces the reply shape,
+# so only the routing rules and a few examples are left.
+SYSTEM_PROMPT_V2 = """Route the user's math question to a tool. Reply with one JSON object:
+{"tool": "calculator", "expression": "<arithmetic>"}
+{"tool": "converter", "value": <number>, "from_unit": "<unit>", "to_unit": "<unit>"}
+{"tool": "algorithm", "operation": "<name>", "inputs": [<numbers>]}
+{"tool": "none", "expression": ""}
+
+Operations: """ + operation_signatures + """
+
+Rules:
+- "expression" uses only numbers and + - * / ** % ( ), never function calls: square root of 25 -> 25 ** 0.5.
+- Prefer "algorithm" whenever an operation fits; use "calculator" for plain arithmetic and roots.
+- Units are lowercase: km, miles, kg, lbs, celsius, fahrenheit.
+- Use only numbers the user stated. If an input is missing or the question is not math, use "none".
+
+Examples:
+"What is 10 + 5?" -> {"tool": "calculator", "expression": "10 + 5"}
+"Convert 100 km to miles" -> {"tool": "converter", "value": 100, "from_unit": "km", "to_unit": "miles"}
+"What is the GCD of 144 and 49?" -> {"tool": "algorithm", "operation": "gcd", "inputs": [144, 49]}
+"What is the capital of France?" -> {"tool": "none", "expression": ""}
+"""
+
+SYSTEM_PROMPT = SYSTEM_PROMPT_V1 if os.getenv('MATHAGENT_PROMPT') == 'v1' else SYSTEM_PROMPT_V2
+
+# Constrains router decoding so the reply is always one of the four tool
+# shapes; malformed JSON and stray prose can no longer be sampled.
+ROUTER_FORMAT = {
+    'anyOf': [
+        {
+            'type': 'object',
+            'properties': {
+                'tool': {'const': 'calculator'},
+                'expression': {'type': 'string'},
+            },
+            'required': ['tool', 'expression'],
+        },
+        {
+            'type': 'object',
+            'properties': {
+                'tool': {'const': 'converter'},
+                'value': {'type': 'number'},
+                'from_unit': {'type': 'string'},
+                'to_unit': {'type': 'string'},
+            },
+            'required': ['tool', 'value', 'from_unit', 'to_unit'],
+        },
+        {
+            'type': 'object',
+            'properties': {
+                'tool': {'const': 'algorithm'},
+                'operation': {'enum': list(ALGORITHM_TOOLS)},
+                'inputs': {'type': 'array', 'items': {'type': 'number'}},
+            },
+            'required': ['tool', 'operation', 'inputs'],
+        },
+        {
+            'type': 'object',
+            'properties': {
+                'tool': {'const': 'none'},
+                'expression': {'type': 'string'},
+            },
+            'required': ['tool'],
+        },
+    ],
+}
+
+# Routing is stateless: every turn is this fixed system message plus the
+# single new user message, so nothing but the user text is ever prefilled.
+SYSTEM_MESSAGE = {'role': 'system', 'content': SYSTEM_PROMPT}
+
+# UTF-8 form of the prompt, hashed into the answer cache keys below. The
+# ollama client still encodes the prompt itself on every call.
+SYSTEM_PROMPT_BYTES = SYSTEM_PROMPT.encode('utf-8')
+
+# Answers are cached on disk across sessions when diskcache is installed,
+# otherwise only for the lifetime of the process.
+if diskcache is not None:
+    cache = diskcache.Cache('.mathagent_cache', eviction_policy='least-recently-used')
+else:
+    cache = {}
+
+# Routing decisions are keyed by (router model, system prompt, question),
+# so switching ROUTER_MODEL or MATHAGENT_PROMPT routes the question again;
+# they do not depend on the tools, which can change downstream. Reworded
+# answers also depend on SUMMARY_MODEL, so it is added to their key.
+_ROUTE_HASH = hashlib.blake2b(
+    ROUTER_MODEL.encode('utf-8') + b'\x00' + SYSTEM_PROMPT_BYTES + b'\x00',
+    digest_size=16)
+_ANSWER_HASH = _ROUTE_HASH.copy()
+_ANSWER_HASH.update(SUMMARY_MODEL.encode('utf-8') + b'\x00')
+
+
+def _answer_key(user_input):
+    h = _ANSWER_HASH.copy()
+    h.update(user_input.encode('utf-8'))
+    return 'answer:' + h.hexdigest()
+
+
+def _route_key(user_input):
+    h = _ROUTE_HASH.copy()
+    h.update(user_input.encode('utf-8'))
+    return 'route:' + h.hexdigest()
+
+
+class ToolError(Exception):
+    # Raised by the tools with a user-facing message; ask() returns it as
+    # the answer so it is printed in order with its question.
+    pass
 
 
 def parse_response(s):
     try:
-        return json.loads(s)
-    except JSONDecodeError:
-        print('Error: Could not decode model response as JSON')
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
         return None
 
 
+def format_calc(expression, result):
+    return f'The result of {expression} is {result:.2f}.'
+
+
+def format_conv(value, from_unit, new_value, to_unit):
+    return f'{value} {from_unit} equals {new_value:.2f} {to_unit}.'
+
+
+def format_algo(operation, inputs, result):
+    return f'{operation}({", ".join(map(str, inputs))}) is {result}.'
+
+
+class InvalidExpression(ValueError):
+    pass
+
+
+# Calculator grammar from the system prompt: numeric literals, + - * / ** % and parentheses.
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+    ast.USub, ast.UAdd,
+)
+
+# Integer powers are only computed when the result stays below 2 ** this,
+# i.e. still converts to the float the result is reported as. Checking the
+# exponent at run time means nested powers such as "9 ** 9 ** 9" are caught
+# as well as literal ones.
+_MAX_POWER_BITS = sys.float_info.max_exp
+
+
+def _safe_pow(base, exponent):
+    if (type(base) is int and type(exponent) is int and exponent > 0
+            and abs(base) > 1
+            and exponent * math.log2(abs(base)) >= _MAX_POWER_BITS):
+        raise OverflowError(f'{base} ** {exponent} is too large')
+    return base ** exponent
+
+
+class _GuardPow(ast.NodeTransformer):
+    # Rewrites every "a ** b" into "_pow(a, b)" so the exponent is checked
+    # on the values actually computed, not just on literals.
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Pow):
+            return ast.Call(func=ast.Name(id='_pow', ctx=ast.Load()),
+                            args=[node.left, node.right], keywords=[])
+        return node
+
+
+_CALC_GLOBALS = {'__builtins__': {}, '_pow': _safe_pow}
+
+
+@lru_cache(maxsize=256)
+def _compile_expression(expression):
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise InvalidExpression(expression) from e
+
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise InvalidExpression(expression)
+        if isinstance(node, ast.Constant) and type(node.value) not in (int, float):
+            raise InvalidExpression(expression)
+
+    tree = ast.fix_missing_locations(_GuardPow().visit(tree))
+    return compile(tree, '<calc>', 'eval')
+
+
 def calculate(parsed):
     tool = parsed['tool']
     expression = parsed['expression']
-    print(f'Calling tool: {tool}')
-    print(f'Expression: {expression}')
+    logger.debug('Calling tool: %s', tool)
+    logger.debug('Expression: %s', expression)
     try:
-        result = simple_eval(expression)
-        return f'Result: {result:.2f}'
+        result = eval(_compile_expression(expression), _CALC_GLOBALS, {})
+        return format_calc(expression, result)
 
     except ZeroDivisionError:
-        print('Error: Division by zero is not allowed')
-        return None
+        raise ToolError('Error: Division by zero is not allowed') from None
 
     except InvalidExpression:
-        print('Error: Could not evaluate expression')
-        return None
+        raise ToolError('Error: Could not evaluate expression') from None
+
+    except OverflowError:
+        raise ToolError('Error: Result is too large to display') from None
 
     except Exception as e:
-        print(f'Error: Unexpected error — {e}')
-        return None
+        raise ToolError(f'Error: Unexpected error — {e}') from None
+
+
+_CONVERT = {
+    ('km', 'miles'): lambda v: v * 0.621371,
+    ('miles', 'km'): lambda v: v * 1.60934,
+    ('kg', 'lbs'): lambda v: v * 2.20462,
+    ('lbs', 'kg'): lambda v: v * 0.453592,
+    ('celsius', 'fahrenheit'): lambda v: (v * 9 / 5) + 32,
+    ('fahrenheit', 'celsius'): lambda v: (v - 32) * 5 / 9,
+}
+
+# Other spellings the model produces, mapped to the keys used in _CONVERT.
+_UNIT_ALIASES = {
+    'kilometers': 'km', 'kilometres': 'km',
+    'mi': 'miles', 'mile': 'miles',
+    'kilograms': 'kg', 'kgs': 'kg',
+    'lb': 'lbs', 'pounds': 'lbs',
+    'c': 'celsius', '°c': 'celsius',
+    'f': 'fahrenheit', '°f': 'fahrenheit',
+}
 
 
 def convert(parsed):
@@ -174,88 +541,246 @@ def convert(parsed):
     value = parsed['value']
     from_unit = parsed['from_unit']
     to_unit = parsed['to_unit']
-    print(f'Calling tool: {tool}')
-    print(f'Converting : {value} {from_unit} to {to_unit}')
-
-    new_value = 0
-    match from_unit + '_' + to_unit:
-        case 'km_miles':
-            new_value = value * 0.621371
-        case 'miles_km':
-            new_value = value * 1.60934
-        case 'kg_lbs':
-            new_value = value * 2.20462
-        case 'lbs_kg':
-            new_value = value * 0.453592
-        case 'celsius_fahrenheit':
-            new_value = (value * 9 / 5) + 32
-        case 'fahrenheit_celsius':
-            new_value = (value - 32) * 5 / 9
-        case _:
-            print(f'Error: Unsupported conversion — {from_unit} to {to_unit}')
-            return None
-
-    return f'Result : {value} {from_unit} = {new_value:.2f} {to_unit}'
+    logger.debug('Calling tool: %s', tool)
+    logger.debug('Converting : %s %s to %s', value, from_unit, to_unit)
+
+    fn = _CONVERT.get((_UNIT_ALIASES.get(from_unit, from_unit),
+                       _UNIT_ALIASES.get(to_unit, to_unit)))
+    if fn is None:
+        raise ToolError(f'Error: Unsupported conversion — {from_unit} to {to_unit}')
+
+    new_value = fn(value)
+    return format_conv(value, from_unit, new_value, to_unit)
 
 
 def run_algorithm(parsed):
     operation = parsed['operation']
     inputs = parsed['inputs']
 
-    if operation not in ALGORITHM_TOOLS:
-        print(f'Error: Unknown operation — {operation}')
-        return None
+    spec = ALGORITHM_TOOLS.get(operation)
+    if spec is None:
+        raise ToolError(f'Error: Unknown operation — {operation}')
 
-    func, desc = ALGORITHM_TOOLS[operation]          # ← get expected input count
-    expected = int(desc.split('[')[1].rstrip(']').count(',')) + 1
+    if len(inputs) != spec.arity:
+        raise ToolError(f'Error: {operation} expects {spec.arity} input(s), got {len(inputs)}')
 
-    if len(inputs) != expected:
-        print(f'Error: {operation} expects {expected} input(s), got {len(inputs)}')
-        return None
+    if not spec.validate(inputs):
+        raise ToolError(f'Error: Invalid input(s) for {operation} — {inputs}')
 
-    print(f'Performing {operation} on {inputs}')
+    logger.debug('Performing %s on %s', operation, inputs)
     try:
-        result = func(*inputs)
-        return f'Result: {operation}({", ".join(map(str, inputs))}) = {result}'
+        result = spec.func(*inputs)
+        return format_algo(operation, inputs, result)
     except Exception as e:
-        print(f'Error: {e}')
-        return None
-
-messages.append({'role': 'system', 'content': SYSTEM_PROMPT})
+        raise ToolError(f'Error: {e}') from None
+
+RESPONSE_PROMPT = "You are a helpful assistant. Answer naturally in one sentence. Do not use JSON."
+RESPONSE_MESSAGE = {'role': 'system', 'content': RESPONSE_PROMPT}
+
+
+async def route(client, user_input):
+    message = [SYSTEM_MESSAGE, {'role': 'user', 'content': user_input}]
+    stream = await client.chat(model=ROUTER_MODEL, messages=message, stream=True,
+                               format=ROUTER_FORMAT, options=ROUTER_OPTIONS,
+                               keep_alive=KEEP_ALIVE)
+
+    # The schema guarantees a single JSON object, so stop reading as soon as its
+    # closing brace arrives; closing the stream frees the server slot
+    # instead of waiting for trailing whitespace to be generated.
+    buf = ''
+    depth = 0
+    async for chunks in stream:
+        content = chunks['message']['content']
+        buf += content
+        depth += content.count('{') - content.count('}')
+        if depth <= 0 and '{' in buf:
+            break
+    await stream.aclose()
+
+    return parse_response(buf)
+
+
+async def ask(client, user_input):
+    # Returns (parsed, result, summary). summary is the text to print:
+    # the templated result, a "none" or error message, or None when the
+    # result still has to be reworded by summarize(). Nothing is printed
+    # here, so concurrent questions can be reported in input order.
+    # Only reworded answers are cached, so template mode never replays an
+    # LLM sentence from an earlier MATHAGENT_NATURAL=1 session.
+    if NATURAL_SUMMARY:
+        answer = cache.get(_answer_key(user_input))
+        if answer is not None:
+            return answer
+
+    parsed = cache.get(_route_key(user_input))
+    if parsed is None:
+        parsed = await route(client, user_input)
+        if parsed is not None:
+            cache[_route_key(user_input)] = parsed
+
+    if parsed is None:
+        return None, '', 'Error: Could not decode model response as JSON'
+    if parsed['tool'] == 'none':
+        return parsed, '', 'I can only handle math questions and conversions'
 
-while True:
-    user_input = input("\nAsk a math question (or type 'exit'): ")
-    if user_input.lower() == 'exit':
-        break
+    try:
+        if parsed['tool'] == 'calculator':
+            result = calculate(parsed)
+        elif parsed['tool'] == 'converter':
+            result = convert(parsed)
+        else:
+            result = run_algorithm(parsed)
+    except ToolError as e:
+        return parsed, '', str(e)
 
-    message = messages + [{'role': 'user', 'content': user_input}]
-    stream = chat(model='llama3.1', messages=message)
+    if NATURAL_SUMMARY:
+        return parsed, result, None
+    return parsed, result, result
 
-    parsed = parse_response(stream['message']['content'])
 
-    result = ''
+async def summarize(client, user_input, parsed, result):
+    message = [
+        RESPONSE_MESSAGE,
+        {'role': 'user', 'content': user_input},
+        {'role': 'assistant', 'content': f'Tool result: {result}'},
+        {'role': 'user', 'content': 'Now summarize that result naturally in one sentence.'}
+    ]
+    stream = await client.chat(model=SUMMARY_MODEL, messages=message, stream=True,
+                               keep_alive=KEEP_ALIVE)
 
-    if parsed is not None:
-        if parsed['tool'] == 'none':
-            print("I can only handle math questions and conversions")
-        elif parsed['tool'].lower() == 'calculator':
-            result = calculate(parsed)
-        elif parsed['tool'].lower() == 'converter':
-            result = convert(parsed)
-        elif parsed['tool'].lower() == 'algorithm':
-            result = run_algorithm(parsed)
+    summary = ''
+    async for chunks in stream:
+        content = chunks['message']['content']
+        summary += content
+        print(content, end='', flush=True)
+    print()
 
-    if result:
-        RESPONSE_PROMPT = "You are a helpful assistant. Answer naturally in one sentence. Do not use JSON."
+    cache[_answer_key(user_input)] = (parsed, result, summary)
 
-        message = [
-            {'role': 'system', 'content': RESPONSE_PROMPT},
-            {'role': 'user', 'content': user_input},
-            {'role': 'assistant', 'content': f'Tool result: {result}'},
-            {'role': 'user', 'content': 'Now summarize that result naturally in one sentence.'}
-        ]
-        stream = chat(model='llama3.1', messages=message, stream=True)
 
-        for chunks in stream:
-            print(chunks['message']['content'], end='', flush=True)
-        print()
+async def ensure_model(client, model):
+    # Only pull when the model is missing locally; pull always contacts the
+    # registry, which would stop an offline machine from starting.
+    try:
+        await client.show(model)
+    except ResponseError as e:
+        if e.status_code != 404:
+            raise
+        await client.pull(model)
+
+
+async def warm_up(client):
+    # Prefill the system prompt once at startup. Every later turn sends it
+    # as element 0, so Ollama matches the shared prefix and skips its
+    # prefill (check "prompt eval count" with OLLAMA_DEBUG=1).
+    response = await client.chat(model=ROUTER_MODEL, messages=[SYSTEM_MESSAGE],
+                                 options={'num_predict': 1}, keep_alive=KEEP_ALIVE)
+    system_tokens = response.get('prompt_eval_count')
+    if system_tokens:
+        ROUTER_OPTIONS['num_keep'] = system_tokens
+
+    # Load the summarizer now rather than on the first answer, but only if
+    # it will actually be used.
+    if NATURAL_SUMMARY and SUMMARY_MODEL != ROUTER_MODEL:
+        await client.generate(model=SUMMARY_MODEL, prompt=' ',
+                              options={'num_predict': 1}, keep_alive=KEEP_ALIVE)
+
+
+def split_questions(line):
+    return [q.strip() for q in line.split(';') if q.strip()]
+
+
+async def answer_all(client, questions):
+    # Route every question concurrently, then print answers in input order.
+    results = await asyncio.gather(*(ask(client, q) for q in questions))
+    _log_handler.flush()
+
+    for question, (parsed, result, summary) in zip(questions, results):
+        if summary is not None:
+            print(f'{question}: {summary}')
+        elif result:
+            print(f'{question}: ', end='')
+            await summarize(client, question, parsed, result)
+
+
+async def run_batch(client, lines):
+    # Script mode: questions piped on stdin are dispatched BATCH_SIZE at a
+    # time so Ollama can spread them over its parallel slots.
+    # Like the REPL, an 'exit' line ends the input.
+    questions = []
+    for line in lines:
+        if line.strip().lower() == 'exit':
+            break
+        questions.extend(split_questions(line))
+    for start in range(0, len(questions), BATCH_SIZE):
+        await answer_all(client, questions[start:start + BATCH_SIZE])
+
+
+def read_stdin_lines(loop):
+    # Lines are read on a daemon thread rather than the default executor:
+    # asyncio.run() joins executor threads on shutdown, so a readline()
+    # blocked there would keep Ctrl-C from exiting until Enter is pressed.
+    lines = asyncio.Queue()
+
+    def reader():
+        try:
+            for line in iter(sys.stdin.readline, ''):
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            loop.call_soon_threadsafe(lines.put_nowait, '')
+        except RuntimeError:
+            # The loop closed while a line was being read.
+            pass
+
+    threading.Thread(target=reader, daemon=True).start()
+    return lines
+
+
+async def repl(client):
+    # The reader runs ahead of the prompt, so typing the next question while
+    # the previous summary is still streaming overlaps with generation.
+    lines = read_stdin_lines(asyncio.get_running_loop())
+    pending = None
+
+    while True:
+        if pending is not None:
+            await pending
+            pending = None
+        print("\nAsk a math question (or type 'exit'): ", end='', flush=True)
+
+        user_input = await lines.get()
+        if not user_input or user_input.strip().lower() == 'exit':
+            break
+
+        questions = split_questions(user_input)
+        if not questions:
+            continue
+
+        if len(questions) > 1:
+            await answer_all(client, questions)
+            continue
+
+        parsed, result, summary = await ask(client, questions[0])
+        _log_handler.flush()
+        if summary is not None:
+            print(summary)
+        elif result:
+            pending = asyncio.create_task(summarize(client, questions[0], parsed, result))
+
+
+async def main():
+    # Set OLLAMA_NUM_PARALLEL on the Ollama server so batched questions are
+    # actually serviced concurrently instead of queued.
+    client = AsyncClient()
+    await ensure_model(client, ROUTER_MODEL)
+    await warm_up(client)
+
+    if sys.stdin.isatty():
+        await repl(client)
+    else:
+        await run_batch(client, sys.stdin.read().splitlines())
+
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print()